@@ -3,16 +3,245 @@ store all the agents here
 """
 
 import os
-from replay_buffer import ReplayBuffer, ReplayBufferNumpy
+import math
+import pickle
+from replay_buffer import ReplayBuffer, ReplayBufferNumpy, ReplayBufferTorch
 import numpy as np
 import time
-import pickle
-from collections import deque
 import json
 import torch 
 import torch.nn as nn
 import torch.optim as optim
 from torchsummary import summary
+from numba import njit, prange, guvectorize
+
+
+@njit(cache=True, fastmath=True)
+def _stable_softmax(x, lo, hi):
+    """Row wise softmax of x after clipping to [lo, hi], computed in one
+    compiled loop per row instead of a Numpy pass per operation. The loop
+    is deliberately serial, a row is only n_actions values and a batch is
+    one row per game (64 here), so the whole call takes a few microseconds
+    and starting a prange thread pool would cost about as much
+
+    Parameters
+    ----------
+    x : Numpy array
+        The model outputs, batch size * num actions
+    lo : float
+        Lower clipping value
+    hi : float
+        Upper clipping value
+
+    Returns
+    -------
+    p : Numpy array
+        The probabilities, batch size * num actions
+    """
+    p = np.empty_like(x)
+    for i in range(x.shape[0]):
+        # clip and get the max for numerical stability
+        m = lo
+        for j in range(x.shape[1]):
+            p[i, j] = min(max(x[i, j], lo), hi)
+            m = max(m, p[i, j])
+        s = 0.0
+        for j in range(x.shape[1]):
+            p[i, j] = np.exp(p[i, j] - m)
+            s += p[i, j]
+        for j in range(x.shape[1]):
+            p[i, j] /= s
+    return p
+
+
+# action for a unit step of the head, indexed as [dy+1, dx+1] where dy
+# is positive going up the board, -1 for steps which are not moves
+_DXDY_TO_ACTION = np.array([[-1,  3, -1],
+                            [ 2, -1,  0],
+                            [-1,  1, -1]], dtype=np.int8)
+
+
+@njit(cache=True)
+def _bfs(board, head, neighbors, row_of, col_of, food_val, board_val, head_val):
+    """Breadth first search from the head to the food on a single frame,
+    compiled so that the queue and neighbor loops run without the
+    interpreter
+
+    Parameters
+    ----------
+    board : Numpy array
+        The board frame, board size * board size
+    head : int
+        The flattened position of the head
+    neighbors : Numpy array
+        Neighbors of every flattened position inside the borders,
+        padded with -1, see Agent._get_neighbor_table
+    row_of : Numpy array
+        Row of every flattened position
+    col_of : Numpy array
+        Column of every flattened position
+    food_val : int
+        Value of the food cell on the board
+    board_val : int
+        Value of an empty cell on the board
+    head_val : int
+        Value of the head cell on the board
+
+    Returns
+    -------
+    path : Numpy array
+        Flattened positions from the food back to the head, only the
+        first length entries are valid
+    length : int
+        Length of the path, 0 if the food cannot be reached
+    """
+    n = board.shape[0]
+    # the point each point was reached from, -1 for the head
+    parent = np.full(n * n, -1, dtype=np.int32)
+    visited = np.zeros(n * n, dtype=np.uint8)
+    visited[head] = 1
+    # points are marked visited when queued, so every point is
+    # queued at most once
+    queue = np.empty(n * n, dtype=np.int32)
+    queue[0] = head
+    q_head, q_tail = 0, 1
+    food = -1
+    while(food == -1 and q_head < q_tail):
+        curr_point = queue[q_head]
+        q_head += 1
+        for k in range(4):
+            p = neighbors[curr_point, k]
+            if(p < 0 or visited[p] == 1):
+                continue
+            v = board[row_of[p], col_of[p]]
+            if(v != board_val and v != food_val and v != head_val):
+                continue
+            # the first visit in breadth first order is the shortest
+            visited[p] = 1
+            parent[p] = curr_point
+            if(v == food_val):
+                # reached food
+                food = p
+                break
+            queue[q_tail] = p
+            q_tail += 1
+
+    path = np.empty(n * n, dtype=np.int32)
+    if(food == -1):
+        # complete board has been explored without finding path
+        return path, 0
+    # create the path going backwards from the food
+    curr_point = food
+    path[0] = curr_point
+    length = 1
+    while(parent[curr_point] != -1):
+        curr_point = parent[curr_point]
+        path[length] = curr_point
+        length += 1
+    return path, length
+
+
+@njit(parallel=True, cache=True)
+def _bfs_batch(boards, neighbors, row_of, col_of, food_val, board_val, head_val):
+    """Actions towards the food along the shortest path for a batch of
+    boards, the boards are searched in parallel threads
+
+    Parameters
+    ----------
+    boards : Numpy array
+        The boards, batch size * board size * board size * frames
+    neighbors : Numpy array
+        Neighbors of every flattened position inside the borders,
+        padded with -1
+    row_of : Numpy array
+        Row of every flattened position
+    col_of : Numpy array
+        Column of every flattened position
+    food_val : int
+        Value of the food cell on the board
+    board_val : int
+        Value of an empty cell on the board
+    head_val : int
+        Value of the head cell on the board
+
+    Returns
+    -------
+    a : Numpy array
+        The actions, 1 where the food cannot be reached
+    """
+    n = boards.shape[1]
+    a = np.zeros(boards.shape[0], dtype=np.uint8)
+    for i in prange(boards.shape[0]):
+        board = boards[i, :, :, 0]
+        # get the head coordinate, first match as in _find_cell
+        curr_head = 0
+        for p in range(n * n):
+            if(board[row_of[p], col_of[p]] == head_val):
+                curr_head = p
+                break
+        path, length = _bfs(board, curr_head, neighbors, row_of, col_of,
+                            food_val, board_val, head_val)
+        if(length == 0):
+            a[i] = 1
+            continue
+        next_head = path[length - 2]
+        dx = col_of[next_head] - col_of[curr_head]
+        dy = -row_of[next_head] + row_of[curr_head]
+        # the path is made of unit steps, so the lookup is always in range
+        a[i] = max(_DXDY_TO_ACTION[dy + 1, dx + 1], 0)
+    return a
+
+
+@guvectorize(['void(float64[:,:,:], int64[:], int32[:], int8[:], int64[:], int64[:], int64, int8[:])',
+              'void(int8[:,:,:], int64[:], int32[:], int8[:], int64[:], int64[:], int64, int8[:])'],
+             '(n,n,f),(c),(p),(p),(p),(p),()->()', cache=True)
+def _hc_move(board, cycle, cycle_index, cycle_action, row_of, col_of, head_val, a):
+    """Hamiltonian cycle action for one board, compiled as a generalized
+    ufunc so that a batch of boards is looped over without the interpreter,
+    see HamiltonianCycleAgent.move for the policy
+
+    Parameters
+    ----------
+    board : Numpy array
+        The board, board size * board size * frames
+    cycle : Numpy array
+        The points of the cycle in order
+    cycle_index : Numpy array
+        Position of every point in the cycle, -1 if not on the cycle
+    cycle_action : Numpy array
+        Action taking every point of the cycle to the next one
+    row_of : Numpy array
+        Row of every flattened position
+    col_of : Numpy array
+        Column of every flattened position
+    head_val : int
+        Value of the head cell on the board
+    a : Numpy array
+        Single element output for the action
+    """
+    n = board.shape[0]
+    cy_len = cycle.shape[0]
+    curr_head = 0
+    for p in range(n * n):
+        if(board[row_of[p], col_of[p], 0] == head_val):
+            curr_head = p
+            break
+    index = cycle_index[curr_head]
+    prev_head = cycle[(index - 1) % cy_len]
+    next_head = cycle[(index + 1) % cy_len]
+    if(board[row_of[prev_head], col_of[prev_head], 0] == 0):
+        # check if snake is in line with the hamiltonian cycle or not
+        a[0] = 3 if next_head > curr_head else 1
+        return
+    if(index >= 0):
+        a[0] = cycle_action[curr_head]
+        return
+    dx = col_of[next_head] - col_of[curr_head]
+    dy = -row_of[next_head] + row_of[curr_head]
+    if(abs(dx) > 1 or abs(dy) > 1):
+        a[0] = -1
+    else:
+        a[0] = _DXDY_TO_ACTION[dy + 1, dx + 1]
 
 
 class Agent():
@@ -43,9 +272,6 @@ class Agent():
         necessary to stabilise DQN learning
     _input_shape : tuple
         Tuple to store individual state shapes
-    _board_grid : Numpy array
-        A square filled with values from 0 to board size **2,
-        Useful when converting between row, col and int representation
     _version : str
         model version string
     """
@@ -78,10 +304,13 @@ class Agent():
         self._gamma = gamma
         self._use_target_net = use_target_net
         self._input_shape = (self._board_size, self._board_size, self._n_frames)
+        # row and column of every flattened point, looked up instead
+        # of converting the point each time
+        self._row_of = np.arange(self._board_size**2)//self._board_size
+        self._col_of = np.arange(self._board_size**2)%self._board_size
+        self._get_neighbor_table()
         # reset buffer also initializes the buffer
         self.reset_buffer()
-        self._board_grid = np.arange(0, self._board_size**2)\
-                             .reshape(self._board_size, -1)
         self._version = version
 
     def get_gamma(self):
@@ -140,7 +369,8 @@ class Agent():
                                    done, legal_moves)
 
     def save_buffer(self, file_path='', iteration=None):
-        """Save the buffer to disk
+        """Save the buffer to disk, as a directory of Numpy arrays
+        which can be memory mapped when loading
 
         Parameters
         ----------
@@ -153,8 +383,7 @@ class Agent():
             assert isinstance(iteration, int), "iteration should be an integer"
         else:
             iteration = 0
-        with open("{}/buffer_{:04d}".format(file_path, iteration), 'wb') as f:
-            pickle.dump(self._buffer, f)
+        self._buffer.save("{}/buffer_{:04d}".format(file_path, iteration))
 
     def load_buffer(self, file_path='', iteration=None):
         """Load the buffer from disk
@@ -167,6 +396,10 @@ class Agent():
             Iteration number to use in case the file has been tagged
             with one, 0 if iteration is None
 
+        Buffers pickled by older versions into a single file (buffer_0001
+        or buffer_0001.pkl) are also read, and converted to the current
+        buffer layout
+
         Raises
         ------
         FileNotFoundError
@@ -176,8 +409,20 @@ class Agent():
             assert isinstance(iteration, int), "iteration should be an integer"
         else:
             iteration = 0
-        with open("{}/buffer_{:04d}".format(file_path, iteration), 'rb') as f:
-            self._buffer = pickle.load(f)
+        path = "{}/buffer_{:04d}".format(file_path, iteration)
+        # older versions pickled the whole buffer object into a single file
+        for legacy_path in [path, path + '.pkl']:
+            if(os.path.isfile(legacy_path)):
+                with open(legacy_path, 'rb') as f:
+                    buffer = pickle.load(f)
+                if(hasattr(buffer, '_next_s')):
+                    # Numpy buffer from before the channels first layout
+                    self.reset_buffer(buffer._buffer_size)
+                    self._buffer.load_legacy(buffer)
+                else:
+                    self._buffer = buffer
+                return
+        self._buffer.load(path)
 
     def _point_to_row_col(self, point):
         """Covert a point value to row, col value
@@ -195,20 +440,51 @@ class Agent():
         """
         return (point//self._board_size, point%self._board_size)
 
+    def _get_neighbor_table(self):
+        """
+        precompute the neighbors inside the borders for every point,
+        _neighbor_table[point] holds upto 4 neighbors padded with -1
+        """
+        n = self._board_size
+        self._neighbor_table = -np.ones((n**2, 4), dtype=np.int32)
+        row, col = self._row_of, self._col_of
+        for k, (delta_row, delta_col) in enumerate([[-1,0], [1,0], [0,1], [0,-1]]):
+            new_row, new_col = row + delta_row, col + delta_col
+            m = (1 <= new_row) & (new_row <= n-2) & (1 <= new_col) & (new_col <= n-2)
+            self._neighbor_table[m, k] = (new_row*n + new_col)[m]
+
+    def _find_cell(self, board, value):
+        """Get the point value of the first cell of a 2D board
+        having the given value, 0 if no cell has the value
+
+        Parameters
+        ----------
+        board : Numpy array
+            A single frame of the board, board size * board size
+        value : int
+            The value to look for
+
+        Returns
+        -------
+        point : int
+            point value of the cell
+        """
+        return int(np.argmax(board == value))
+
     def _row_col_to_point(self, row, col):
         """Covert a (row, col) to value
         point value is the array index when it is flattened
 
         Parameters
         ----------
-        row : int
-            The row number in array
-        col : int
-            The column number in array
+        row : int or Numpy array
+            The row number(s) in array
+        col : int or Numpy array
+            The column number(s) in array
         Returns
         -------
-        point : int
-            point value corresponding to the row and col values
+        point : int or Numpy array
+            point value(s) corresponding to the row and col values
         """
         return row*self._board_size + col
 
@@ -274,64 +550,217 @@ class DQN(nn.Module):
 
 class DeepQLearningAgent(Agent):
 
-    def __init__(self, board_size=10, frames=4, buffer_size=10000, gamma=0.99, n_actions=3, use_target_net=True, version=''):
-        Agent.__init__(self,board_size=board_size, frames=frames, buffer_size=buffer_size, gamma=gamma, n_actions=n_actions, use_target_net=use_target_net, version=version)
-
+    def __init__(self, board_size=10, frames=4, buffer_size=10000, gamma=0.99, n_actions=3, use_target_net=True, version='',
+                 buffer_on_device=None):
+        # the device is needed before the buffer is created in Agent.__init__
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f"Using device: {self.device}")
 
+        # Keep the replay buffer on the device by default when using a gpu,
+        # the numpy buffer is used for cpu only runs
+        if buffer_on_device is None:
+            buffer_on_device = self.device.type == 'cuda'
+        self._buffer_on_device = buffer_on_device
+
+        Agent.__init__(self,board_size=board_size, frames=frames, buffer_size=buffer_size, gamma=gamma, n_actions=n_actions, use_target_net=use_target_net, version=version)
+
+        # Staging buffers reused by every inference upload, allocated on first
+        # use and grown with the batch size, see _stage_board
+        self._stage_cpu = None
+        self._stage_gpu = None
+        if self.device.type == 'cuda':
+            self._copy_stream = torch.cuda.Stream(self.device)
+            self._copy_event = torch.cuda.Event()
+
+        # Compiled inference functions of the models keyed by the model's id,
+        # only filled on cuda, see _compile_model
+        self._compiled_forward = {}
+
         # Initialize or reset the models (main model and target model if used)
         self.reset_models()
 
-        # Define the optimizer for updating model parameters, here using RMSprop
-        self._optimizer = optim.RMSprop(self._model.parameters(), lr=0.0005)
+        # Define the optimizer for updating model parameters, here using RMSprop,
+        # foreach updates all the parameters with a few multi tensor kernels
+        self._optimizer = optim.RMSprop(self._model.parameters(), lr=0.0005, foreach=True)
 
         # Define the loss function, here using Smooth L1 Loss which is also known as Huber Loss, which was used in the original tf code
         self._criterion = nn.SmoothL1Loss()
 
+    def reset_buffer(self, buffer_size=None):
+        """Reset current buffer, the buffer is allocated on the device
+        if _buffer_on_device is set
+
+        Parameters
+        ----------
+        buffer_size : int, optional
+            Initialize the buffer with buffer_size, if not supplied,
+            use the original value
+        """
+        if(not self._buffer_on_device):
+            Agent.reset_buffer(self, buffer_size)
+            return
+        if(buffer_size is not None):
+            self._buffer_size = buffer_size
+        self._buffer = ReplayBufferTorch(self._buffer_size, self._board_size,
+                                         self._n_frames, self._n_actions,
+                                         device=self.device)
+
     def reset_models(self):
 
         """ Reset all the models by creating new graphs"""
-        self._model = self._agent_model().to(self.device)
+        self._compiled_forward.clear()
+        self._model = self._compile_model(self._agent_model().to(self.device))
         if(self._use_target_net):
-            self._target_net = self._agent_model().to(self.device)
+            self._target_net = self._compile_model(self._agent_model().to(self.device))
             self.update_target_net()
 
+    def _compile_model(self, model):
+        """Compile the inference pass of the model when running on cuda,
+        for this small conv net the per call framework overhead is larger
+        than the compute. reduce-overhead mode replays the forward pass as
+        a cuda graph, which is captured once per input shape, so only
+        _forward_t uses the compiled function and pads every batch to a
+        fixed size (see _padded_batch_size). Training keeps the eager
+        model, the model itself is returned unchanged so that the state
+        dict keys (used for saving and the target net) stay the same"""
+        if self.device.type == 'cuda':
+            self._compiled_forward[id(model)] = torch.compile(
+                        model, mode='reduce-overhead', dynamic=False)
+        return model
+
+    def _padded_batch_size(self, n):
+        """Round a batch size up to the next power of two, at least 32,
+        so that the compiled models only ever see a handful of input
+        shapes (32 to 1024 for the batches used here, within dynamo's
+        default limit of 8 recompiles per function)"""
+        return max(32, 1 << max(n - 1, 0).bit_length())
+
     def _prepare_input(self, board):
 
+        if(board.ndim == 3):
+            board = board.reshape((1,) + board.shape)
+        # _normalize_board already returns a new array, board is never modified
+        return self._normalize_board(board)
+
+    def _get_model_outputs(self, board, model=None, return_tensor=False):
+        """Get the model outputs for boards coming from the env
+
+        Parameters
+        ----------
+        board : Numpy array
+            Single board or a batch of boards, channels last
+        model : torch Module, optional
+            The model to use, defaults to the agent's current model
+        return_tensor : bool, optional
+            If True, return the outputs as a tensor on the device, for
+            callers which keep working on the device (no host sync)
+
+        Returns
+        -------
+        model_outputs : Numpy array or torch Tensor
+            Outputs of the model, batch size * num actions
+        """
+        # Reshape a single board into a batch of one
         if(board.ndim == 3):
             board = board.reshape((1,) + self._input_shape)
-        board = self._normalize_board(board.copy())
-        return board.copy()
 
-    def _get_model_outputs(self, board, model=None):
-        # Prepare the input board by normalizing and reshaping it
-        board = self._prepare_input(board)
+        # Boards only hold small integers, upload them as uint8 (a quarter of the
+        # float32 bytes) and normalize/reshape to the model's input format on the device
+        reshaped_board = self._normalize_board_t(self._stage_board(board))
+
+        # Pass the reshaped board through the model to get the output predictions
+        model_outputs = self._forward_t(reshaped_board, model)
 
+        # Callers which keep working on the device skip the copy to host
+        if return_tensor:
+            return model_outputs
+
+        # Convert the model outputs to a numpy array and return
+        return model_outputs.cpu().numpy()
+
+    def _forward_t(self, board_t, model=None):
+        """Inference on a batch which is already normalized and on the device,
+        skips all the numpy preparation done in _get_model_outputs"""
         # Use the provided model if given, otherwise default to the agent's current model
         if model is None:
             model = self._model
 
-        # Convert the board to a PyTorch tensor, reshape it to match the model's expected input format
-        reshaped_board = torch.from_numpy(board).float().reshape(-1, 2, 10, 10).to(self.device)
-
+        compiled = self._compiled_forward.get(id(model))
         # Disable gradient calculations for performance improvement during inference
         with torch.no_grad():
-            # Pass the reshaped board through the model to get the output predictions
-            model_outputs = model(reshaped_board)
-
-        # Convert the model outputs to a numpy array and return
-        return model_outputs.cpu().numpy()
+            if compiled is None:
+                return model(board_t)
+            # pad to a fixed set of shapes so that no new graph is captured
+            # for every batch size seen, the rows added are dropped again
+            n = board_t.shape[0]
+            size = self._padded_batch_size(n)
+            if size != n:
+                board_t = torch.cat([board_t, board_t.new_zeros((size - n,) + board_t.shape[1:])])
+            # the graph's output memory is reused by the next replay, so
+            # the rows kept are copied out of it
+            return compiled(board_t)[:n].clone()
 
     def _normalize_board(self, board):
 
         return board.astype(np.float32)/4.0
 
+    def _normalize_board_t(self, board_t):
+        """Normalize an already uploaded board tensor on the device and
+        reshape it to the model's input format, boards are uploaded as
+        uint8 and only cast to float32 here. Boards are already channels
+        first, so the reshape only adds the batch dimension if needed.
+        The multiply is out of place so the input is never modified, for
+        uint8 boards it already produces float32 and the cast is a no-op"""
+        return board_t.mul(0.25).to(torch.float32)\
+                      .reshape(-1, self._n_frames, self._board_size, self._board_size)
+
+    def _stage_board(self, board):
+        """Upload a batch of boards as uint8 through preallocated staging
+        buffers, so no new host or device memory is allocated per call.
+        The env boards are channels last and are transposed to channels
+        first while copying into the staging buffer.
+        On cuda the host buffer is pinned and the copy is issued on a
+        separate stream which the compute stream then waits on"""
+        n = board.shape[0]
+        board = board.transpose(0, 3, 1, 2)
+        if self._stage_cpu is None or self._stage_cpu.shape[0] < n:
+            shape = (n, self._n_frames, self._board_size, self._board_size)
+            self._stage_cpu = torch.empty(shape, dtype=torch.uint8,
+                                          pin_memory=(self.device.type == 'cuda'))
+            self._stage_gpu = torch.empty(shape, dtype=torch.uint8, device=self.device)
+        if self.device.type != 'cuda':
+            np.copyto(self._stage_cpu[:n].numpy(), board, casting='unsafe')
+            return self._stage_cpu[:n]
+        # the previous copy must have finished reading the host buffer
+        self._copy_event.synchronize()
+        np.copyto(self._stage_cpu[:n].numpy(), board, casting='unsafe')
+        # and the previous forward pass must have finished reading the device buffer
+        self._copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self._copy_stream):
+            self._stage_gpu[:n].copy_(self._stage_cpu[:n], non_blocking=True)
+            self._copy_event.record()
+        torch.cuda.current_stream(self.device).wait_stream(self._copy_stream)
+        return self._stage_gpu[:n]
+
+    def _to_device(self, array, dtype=None):
+        """Upload a numpy array to the agent's device, tensors sampled from
+        a buffer on the device are only cast. These arrays are small (legal
+        moves, sampled batches), so they are copied directly; pinning them
+        would allocate page locked memory on every call, the boards which
+        are uploaded on every move go through _stage_board instead"""
+        if isinstance(array, torch.Tensor):
+            return array.to(self.device, dtype=dtype)
+        return torch.from_numpy(np.ascontiguousarray(array)).to(self.device, dtype=dtype)
+
     def move(self, board, legal_moves, value=None):
 
-        model_outputs = self._get_model_outputs(board, self._model)
+        model_outputs = self._get_model_outputs(board, self._model, return_tensor=True)
 
-        return np.argmax(np.where(legal_moves == 1, model_outputs, -np.inf), axis=1)
+        # Mask the illegal moves and take the argmax on the device, only the
+        # selected actions are copied back to host
+        legal_moves = self._to_device(legal_moves).reshape(model_outputs.shape)
+        model_outputs = model_outputs.masked_fill(legal_moves != 1, float('-inf'))
+        return model_outputs.argmax(dim=1).cpu().numpy()
     
     def _agent_model(self):
 
@@ -339,82 +768,98 @@ class DeepQLearningAgent(Agent):
 
         return model
 
-    def get_action_proba(self, board, values=None):
+    def get_action_proba(self, board, values=None, return_tensor=False):
 
-        model_outputs = self._get_model_outputs(board, self._model)
-        model_outputs = np.clip(model_outputs, -10, 10)  # Clip values for stability
-    
-        # Subtract max for numerical stability before softmax
-        model_outputs -= model_outputs.max(axis=1, keepdims=True)
-    
-        # Apply softmax
-        exp_outputs = np.exp(model_outputs)
-        probabilities = exp_outputs / exp_outputs.sum(axis=1, keepdims=True)
-    
-        return probabilities
+        # On cpu the outputs are already on host, the compiled loop is
+        # cheaper than the torch op dispatch for these small arrays
+        if self.device.type == 'cpu' and not return_tensor:
+            return _stable_softmax(self._get_model_outputs(board, self._model), -10.0, 10.0)
+
+        model_outputs = self._get_model_outputs(board, self._model, return_tensor=True)
+
+        # Clip values for stability and apply softmax on the device in one
+        # fused op, the max is subtracted internally for numerical stability
+        probabilities = torch.softmax(model_outputs.clamp(-10, 10), dim=1)
+
+        # Callers which keep working on the device skip the copy to host
+        if return_tensor:
+            return probabilities
+        return probabilities.cpu().numpy()
     
     def save_model(self, file_path='', iteration=None):
-        """Save the current models to disk using PyTorch's functionality"""
+        """Save the current models to disk using PyTorch's functionality,
+        the zipfile format allows memory mapping the files when loading"""
         if iteration is None:
             iteration = 0
-        torch.save(self._model.state_dict(), f"{file_path}/model_{iteration:04d}.pt")
+        torch.save(self._model.state_dict(), f"{file_path}/model_{iteration:04d}.pt",
+                   _use_new_zipfile_serialization=True)
         if self._use_target_net:
-            torch.save(self._target_net.state_dict(), f"{file_path}/model_{iteration:04d}_target.pt")
+            torch.save(self._target_net.state_dict(), f"{file_path}/model_{iteration:04d}_target.pt",
+                       _use_new_zipfile_serialization=True)
 
     def load_model(self, file_path='', iteration=None):
-        """Load models from disk using PyTorch's functionality"""
+        """Load models from disk using PyTorch's functionality, the files
+        are memory mapped instead of read fully into host memory first"""
         if iteration is None:
             iteration = 0
         model_path = f"{file_path}/model_{iteration:04d}.pt"
         target_model_path = f"{file_path}/model_{iteration:04d}_target.pt"
 
         if os.path.exists(model_path):
-            self._model.load_state_dict(torch.load(model_path, map_location=self.device))
+            self._model.load_state_dict(torch.load(model_path, map_location=self.device,
+                                                  mmap=True, weights_only=True))
         else:
             raise FileNotFoundError(f"Model file not found: {model_path}")
 
         if self._use_target_net and os.path.exists(target_model_path):
-            self._target_net.load_state_dict(torch.load(target_model_path, map_location=self.device))
+            self._target_net.load_state_dict(torch.load(target_model_path, map_location=self.device,
+                                                       mmap=True, weights_only=True))
         elif self._use_target_net:
             raise FileNotFoundError(f"Target model file not found: {target_model_path}")
 
     def train_agent(self, batch_size=32, num_games=1, reward_clip=False):
-        # Sample a batch of experiences from the replay buffer
-        states, actions, rewards, next_states, dones, legal_moves = self._buffer.sample(batch_size)
+        # Sample a batch of experiences from the replay buffer, with replacement
+        # since the batch is tiny compared to the buffer and this avoids
+        # touching every position of the buffer
+        states, actions, rewards, next_states, dones, legal_moves = \
+                self._buffer.sample(batch_size, replace=True)
+
+        # Upload the batch to the device once (no copy if the buffer is already
+        # on the device), everything below stays on the device
+        states = self._normalize_board_t(self._to_device(states))
+        next_states = self._normalize_board_t(self._to_device(next_states))
+        # Index of the action taken from the one hot encoding
+        actions = self._to_device(actions).argmax(dim=1, keepdim=True)
+        rewards = self._to_device(rewards, dtype=torch.float32)
+        dones = self._to_device(dones, dtype=torch.float32)
+        legal_moves = self._to_device(legal_moves)
 
         # Optionally clip rewards to -1, 0, or 1 to reduce variance
         if reward_clip:
-            rewards = np.sign(rewards)
+            rewards = torch.sign(rewards)
 
         # Choose the appropriate model (target network or regular model) for prediction
         model_to_use = self._target_net if self._use_target_net else self._model
         # Get predicted future rewards for the next states
-        future_rewards = self._get_model_outputs(next_states, model_to_use)
+        future_rewards = self._forward_t(next_states, model_to_use)
 
         # Calculate discounted future rewards; factor in whether the state was terminal (done)
-        discounted_future_rewards = rewards + \
-            (self._gamma * np.max(np.where(legal_moves == 1, future_rewards, -10000), axis=1)\
-                                      .reshape(-1, 1)) * (1 - dones)
-
-        # Get the current model's predictions for the current states
-        current_predictions = self._get_model_outputs(states)
-
-        # Update target values based on the actions taken
-        updated_targets = (1 - actions) * current_predictions + actions * discounted_future_rewards
+        future_rewards = future_rewards.masked_fill(legal_moves == 0, -10000)
+        max_future_rewards, _ = future_rewards.max(dim=1, keepdim=True)
+        discounted_future_rewards = rewards + self._gamma * max_future_rewards * (1 - dones)
 
         # Zero out gradients from previous steps
         self._model.zero_grad()
 
-        # Prepare the input states and normalize them for the model
-        input_states = torch.tensor(self._normalize_board(states), requires_grad=True).float().reshape(-1, 2, 10, 10).to(self.device)
         # Get the model's output predictions for the current states
-        model_outputs = self._model(input_states)
+        model_outputs = self._model(states)
 
-        # Convert updated target values into a tensor for loss computation
-        target_tensor = torch.tensor(updated_targets, requires_grad=False).to(torch.float32).to(self.device)
+        # Only the actions taken have a target, the other actions contribute no loss
+        q_taken = model_outputs.gather(1, actions)
 
-        # Calculate the loss between the model's predictions and the updated targets
-        loss = self._criterion(model_outputs, target_tensor)
+        # Calculate the loss between the model's predictions and the targets, dividing
+        # by n_actions keeps the scale of the mean over all the (batch, n_actions) outputs
+        loss = self._criterion(q_taken, discounted_future_rewards) / self._n_actions
         # Backpropagate the loss through the network
         loss.backward()
         # Update the model's weights based on the loss gradient
@@ -423,15 +868,31 @@ class DeepQLearningAgent(Agent):
         # Detach the loss and convert to numpy for external use
         return loss.detach().cpu().numpy()
 
-    def update_target_net(self):
+    def update_target_net(self, tau=1.0):
+        """Update the target network in place from the current model,
+        tau < 1 does a soft (Polyak) update instead of a full copy"""
         if self._use_target_net:
-            self._target_net.load_state_dict(self._model.state_dict())
+            with torch.no_grad():
+                for p_target, p_model in zip(self._target_net.parameters(), self._model.parameters()):
+                    if tau == 1.0:
+                        p_target.copy_(p_model)
+                    else:
+                        p_target.mul_(1 - tau).add_(p_model, alpha=tau)
 
     def compare_weights(self):
-        for i, (layer_model, layer_target) in enumerate(zip(self._model.parameters(), self._target_net.parameters())):
-            c = (layer_model.data.numpy() == layer_target.data.numpy()).all()
+        """Check layer by layer if the model and target net weights match,
+        the comparisons run on the device the parameters are on"""
+        model_params = [p.detach() for p in self._model.parameters()]
+        target_params = [p.detach() for p in self._target_net.parameters()]
+        for i, (layer_model, layer_target) in enumerate(zip(model_params, target_params)):
+            c = torch.equal(layer_model, layer_target)
             print(layer_model)
             print('Layer {:d} Weights Match: {:s}'.format(i, str(c)))
+        # largest absolute difference across all the layers in a single reduction
+        max_diff = torch.linalg.vector_norm(
+                        nn.utils.parameters_to_vector(model_params)
+                        - nn.utils.parameters_to_vector(target_params), ord=float('inf')).item()
+        print('Max Weight Difference: {:f}'.format(max_diff))
 
 
     def copy_weights_from_agent(self, agent_for_copy):
@@ -451,21 +912,25 @@ class PolicyGradientAgent(DeepQLearningAgent):
     _update_function : function
         defines the policy update function to use while training
     """
-    def __init__(self, board_size=10, frames=4, buffer_size=10000, gamma=0.99, n_actions=3, version=''):
-        super(PolicyGradientAgent, self).__init__(board_size=board_size, frames=frames, buffer_size=buffer_size, gamma=gamma, n_actions=n_actions, use_target_net=False, version=version)
-        self._actor_optimizer = optim.Adam(self._model.parameters(), lr=1e-6)
+    def __init__(self, board_size=10, frames=4, buffer_size=10000, gamma=0.99, n_actions=3, version='',
+                 buffer_on_device=None):
+        super(PolicyGradientAgent, self).__init__(board_size=board_size, frames=frames, buffer_size=buffer_size, gamma=gamma, n_actions=n_actions, use_target_net=False, version=version,
+                                                  buffer_on_device=buffer_on_device)
+        # fused kernels for the parameter update are available on cuda
+        self._actor_optimizer = optim.Adam(self._model.parameters(), lr=1e-6,
+                                           fused=(self.device.type == 'cuda'))
 
     def _agent_model(self):
         return DQN(self.config, self._board_size, self._n_frames, self._n_actions)
 
     def train_agent(self, batch_size=32, beta=0.1, normalize_rewards=False, num_games=1, reward_clip=False):
-        # Sample the full buffer
-        states, actions, rewards, _, _, _ = self._buffer.sample(self._buffer.get_current_size())
+        # Use the full buffer, order does not matter for the loss
+        states, actions, rewards, _, _, _ = self._buffer.view_all()
 
         # Convert to PyTorch tensors
-        states = torch.tensor(states, dtype=torch.float32, device=self.device)
-        actions = torch.tensor(actions, dtype=torch.long, device=self.device)
-        rewards = torch.tensor(rewards, dtype=torch.float32, device=self.device)
+        states = self._normalize_board_t(self._to_device(states))
+        actions = self._to_device(actions).argmax(dim=1)
+        rewards = self._to_device(rewards, dtype=torch.float32)
 
         # Normalize rewards if required
         if normalize_rewards:
@@ -505,13 +970,13 @@ class AdvantageActorCriticAgent(PolicyGradientAgent):
     """
     def __init__(self, board_size=10, frames=4, buffer_size=10000,
                  gamma = 0.99, n_actions=3, use_target_net=True,
-                 version=''):
+                 version='', buffer_on_device=None):
         DeepQLearningAgent.__init__(self, board_size=board_size, frames=frames,
                                 buffer_size=buffer_size, gamma=gamma,
                                 n_actions=n_actions, use_target_net=use_target_net,
-                                version=version)
+                                version=version, buffer_on_device=buffer_on_device)
         #self._optimizer = tf.keras.optimizers.RMSprop(5e-4)
-        self._optimizer = torch.optim.RMSprop(self._model.parameters(), lr=5e-4)
+        self._optimizer = torch.optim.RMSprop(self._model.parameters(), lr=5e-4, foreach=True)
 
     def _agent_model(self):
 
@@ -597,13 +1062,25 @@ class AdvantageActorCriticAgent(PolicyGradientAgent):
             self._values_model.load_weights("{}/model_{:04d}_values.h5".format(file_path, iteration))
             self._target_net.load_weights("{}/model_{:04d}_target.h5".format(file_path, iteration))
 
-    def update_target_net(self):
+    def update_target_net(self, tau=1.0):
         """Update the weights of the target network, which is kept
         static for a few iterations to stabilize the other network.
         This should not be updated very frequently
+
+        Parameters
+        ----------
+        tau : float, optional
+            Weight of the values model in the update, 1 copies the weights
+            while < 1 does a soft (Polyak) update
         """
         if(self._use_target_net):
-            self._target_net.set_weights(self._values_model.get_weights())
+            with torch.no_grad():
+                for p_target, p_values in zip(self._target_net.parameters(),
+                                              self._values_model.parameters()):
+                    if(tau == 1.0):
+                        p_target.copy_(p_values)
+                    else:
+                        p_target.mul_(1 - tau).add_(p_values, alpha=tau)
 
     def train_agent(self, batch_size=32, beta=0.001, normalize_rewards=False,
                     num_games=1, reward_clip=False):
@@ -718,46 +1195,51 @@ class HamiltonianCycleAgent(Agent):
                  version=version)
         # self._get_cycle()
         self._get_cycle_square()
-    
+
     def _get_neighbors(self, point):
         """
         point is a single integer such that 
         row = point//self._board_size
         col = point%self._board_size
         """
-        row, col = point//self._board_size, point%self._board_size
-        neighbors = []
-        for delta_row, delta_col in [[-1,0], [1,0], [0,1], [0,-1]]:
-            new_row, new_col = row + delta_row, col + delta_col
-            if(1 <= new_row and new_row <= self._board_size-2 and\
-               1 <= new_col and new_col <= self._board_size-2):
-                neighbors.append(new_row*self._board_size + new_col)
-        return neighbors
+        n = self._neighbor_table[point]
+        return n[n >= 0]
 
     def _hamil_util(self):
-        neighbors = self._get_neighbors(self._cycle[self._index])
-        if(self._index == ((self._board_size-2)**2)-1):
-            if(self._start_point in neighbors):
-                # end of path and cycle
-                return True
-            else:
-                # end of path but not cycle
-                return False
-        else:
-            for i in neighbors:
-                if(i not in self._cycle_set):
+        """
+        backtracking search for the hamiltonian cycle starting from the
+        point already at _cycle[_index], an explicit stack is used instead
+        of recursion and the points in the cycle are kept as bits of an int
+        """
+        cy_len = (self._board_size-2)**2
+        # python ints for the bit shifts, -1 pads missing neighbors
+        neighbors = self._neighbor_table.tolist()
+        visited = 1 << self._start_point
+        # for every point in the current path, the neighbors yet to be tried
+        stack = [iter(neighbors[self._start_point])]
+        while(stack):
+            if(self._index == cy_len-1):
+                if(self._start_point in neighbors[self._cycle[self._index]]):
+                    # end of path and cycle
+                    return True
+                # end of path but not cycle, remove the element and backtrack
+                stack.pop()
+                visited &= ~(1 << int(self._cycle[self._index]))
+                self._index -= 1
+                continue
+            for i in stack[-1]:
+                if(i >= 0 and not (visited >> i) & 1):
                     self._index += 1
                     self._cycle[self._index] = i
-                    self._cycle_set.add(i)
-                    ret = self._hamil_util()
-                    if(ret):
-                        return True
-                    else:
-                        # remove the element and backtrack
-                        self._cycle_set.remove(self._cycle[self._index])
-                        self._index -= 1
-            # if all neighbors in cycle set
-            return False
+                    visited |= 1 << i
+                    stack.append(iter(neighbors[i]))
+                    break
+            else:
+                # all neighbors in cycle set, remove the element and backtrack
+                stack.pop()
+                visited &= ~(1 << int(self._cycle[self._index]))
+                self._index -= 1
+        return False
 
     def _get_cycle(self):
         """
@@ -767,12 +1249,12 @@ class HamiltonianCycleAgent(Agent):
         note that the board starts at row 1, col 1
         """
         self._start_point = 1*self._board_size + 1
-        self._cycle = np.zeros(((self._board_size-2) ** 2,))
+        self._cycle = np.zeros(((self._board_size-2) ** 2,), dtype=np.int64)
         # calculate the cycle path, start at 0, 0
         self._index = 0
         self._cycle[self._index] = self._start_point
-        self._cycle_set = set([self._start_point])
         cycle_possible = self._hamil_util()
+        self._get_cycle_index()
 
     def _get_cycle_square(self):
         """
@@ -808,42 +1290,53 @@ class HamiltonianCycleAgent(Agent):
                     sp = ((sp//self._board_size)+1)*self._board_size + ((sp%self._board_size)+1)
             self._cycle[index] = sp
             index += 1
+        self._get_cycle_index()
+
+    def _get_cycle_index(self):
+        """
+        inverse map of the cycle, _cycle_index[point] is the position
+        of point in the cycle (-1 if not on the cycle), makes finding
+        the head in the cycle O(1)
+        """
+        cy_len = (self._board_size-2)**2
+        self._cycle_index = -np.ones(self._board_size**2, dtype=np.int32)
+        self._cycle_index[self._cycle[:cy_len]] = np.arange(cy_len)
+        # action taking every point of the cycle to the next one,
+        # -1 if the points are not adjacent or not on the cycle
+        curr_point = self._cycle[:cy_len]
+        next_point = np.roll(curr_point, -1)
+        dx = self._col_of[next_point] - self._col_of[curr_point]
+        dy = -self._row_of[next_point] + self._row_of[curr_point]
+        m = (np.abs(dx) <= 1) & (np.abs(dy) <= 1)
+        self._cycle_action = -np.ones(self._board_size**2, dtype=np.int8)
+        self._cycle_action[curr_point[m]] = _DXDY_TO_ACTION[dy[m]+1, dx[m]+1]
 
     def move(self, board, legal_moves, values):
         """ get the action using agent policy """
         cy_len = (self._board_size-2)**2
-        curr_head = np.sum(self._board_grid * \
-            (board[:,:,0]==values['head']).reshape(self._board_size, self._board_size))
-        index = 0
-        while(1):
-            if(self._cycle[index] == curr_head):
-                break
-            index = (index+1)%cy_len
+        curr_head = self._find_cell(board[:,:,0], values['head'])
+        index = int(self._cycle_index[curr_head])
         prev_head = self._cycle[(index-1)%cy_len]
         next_head = self._cycle[(index+1)%cy_len]
         # get the next move
-        if(board[prev_head//self._board_size, prev_head%self._board_size, 0] == 0):
+        if(board[self._row_of[prev_head], self._col_of[prev_head], 0] == 0):
             # check if snake is in line with the hamiltonian cycle or not
             if(next_head > curr_head):
                 return 3
             else:
                 return 1
+        elif(index >= 0):
+            # the head is on the cycle, follow it
+            return int(self._cycle_action[curr_head])
         else:
             # calcualte intended direction to get move
-            curr_head_row, curr_head_col = self._point_to_row_col(curr_head)
-            prev_head_row, prev_head_col = self._point_to_row_col(prev_head)
-            next_head_row, next_head_col = self._point_to_row_col(next_head)
+            curr_head_row, curr_head_col = self._row_of[curr_head], self._col_of[curr_head]
+            prev_head_row, prev_head_col = self._row_of[prev_head], self._col_of[prev_head]
+            next_head_row, next_head_col = self._row_of[next_head], self._col_of[next_head]
             dx, dy = next_head_col - curr_head_col, -next_head_row + curr_head_row
-            if(dx == 1 and dy == 0):
-                return 0
-            elif(dx == 0 and dy == 1):
-                return 1
-            elif(dx == -1 and dy == 0):
-                return 2
-            elif(dx == 0 and dy == -1):
-                return 3
-            else:
+            if(abs(dx) > 1 or abs(dy) > 1):
                 return -1
+            return int(_DXDY_TO_ACTION[dy+1, dx+1])
                 
             """
             # calculate vectors representing current and new directions
@@ -860,6 +1353,27 @@ class HamiltonianCycleAgent(Agent):
                 return 2
             """
 
+    def move_batch(self, boards, values):
+        """Actions for a batch of boards, same policy as move
+        but computed in a single compiled call
+
+        Parameters
+        ----------
+        boards : Numpy array
+            The boards, batch size * board size * board size * frames
+        values : dict
+            The env values of the board cells
+
+        Returns
+        -------
+        a : Numpy array
+            The actions as int8, -1 where move would return -1
+        """
+        cy_len = (self._board_size-2)**2
+        return _hc_move(boards, self._cycle[:cy_len], self._cycle_index,
+                        self._cycle_action, self._row_of, self._col_of,
+                        values['head'])
+
     def get_action_proba(self, board, values):
         """ for compatibility """
         move = self.move(board, values)
@@ -892,13 +1406,13 @@ class SupervisedLearningAgent(DeepQLearningAgent):
     """
     def __init__(self, board_size=10, frames=2, buffer_size=10000,
                  gamma=0.99, n_actions=3, use_target_net=True,
-                 version=''):
+                 version='', buffer_on_device=None):
         """Initializer for SupervisedLearningAgent, similar to DeepQLearningAgent
         but creates extra layer and model for classification training
         """        
         DeepQLearningAgent.__init__(self, board_size=board_size, frames=frames, buffer_size=buffer_size,
                  gamma=gamma, n_actions=n_actions, use_target_net=use_target_net,
-                 version=version)
+                 version=version, buffer_on_device=buffer_on_device)
         
         '''
         # define model with softmax activation, and use action as target
@@ -918,16 +1432,36 @@ class SupervisedLearningAgent(DeepQLearningAgent):
         self.criterion = nn.CrossEntropyLoss()
         self.optimizer = torch.optim.Adam(self._model_action.parameters(), lr=0.0005)
 
+        # valid positions of the buffer, the buffer and its version
+        # they were read from
+        self._idx_cache = (None, None, -1)
+
+    def _get_buffer_indices(self):
+        """All the valid positions in the buffer, in random order. Only the
+        positions are cached (until the buffer is modified or replaced),
+        the boards are gathered and normalized one batch at a time
+
+        Returns
+        -------
+        idx : Numpy array or torch Tensor
+            Positions in the buffer, on the buffer's device
+        """
+        idx, buffer, version = self._idx_cache
+        if(buffer is not self._buffer or version != self._buffer.get_version()):
+            idx = self._buffer.sample_indices(self.get_buffer_size())
+            self._idx_cache = (idx, self._buffer, self._buffer.get_version())
+        return idx
+
     def train_agent(self, batch_size=32, num_games=1, epochs=5, 
                     reward_clip=False):
-        """Train the model by sampling from buffer and return the error.
-        _model_action is trained as a classification problem to learn weights
-        for all the layers of the DQN model
+        """Train the model on all the examples in the buffer and return
+        the error. The model is trained as a classification problem on the
+        actions taken, to learn weights for all the layers of the DQN model
         
         Parameters
         ----------
         batch_size : int, optional
-            The number of examples to sample from buffer, should be small
+            The number of examples per gradient step
         num_games : int, optional
             Not used here, kept for consistency with other agents
         epochs : int, optional
@@ -938,13 +1472,31 @@ class SupervisedLearningAgent(DeepQLearningAgent):
         Returns
         -------
             loss : float
-            The current error (error metric is cross entropy)
+            The mean error over the last epoch (error metric is cross entropy)
         """
-        s, a, _, _, _, _ = self._buffer.sample(self.get_buffer_size())
-        # fit using the actions as assumed to be best
-        history = self._model_action.fit(self._normalize_board(s), a, epochs=epochs)
-        loss = round(history.history['loss'][-1], 5)
-        # loss = self._model_action.evaluate(self._normalize_board(s), a, verbose=0)
+        idx = self._get_buffer_indices()
+        n = idx.shape[0]
+        total_loss = 0.0
+        for _ in range(epochs):
+            # go over the examples in a new order every epoch
+            if(isinstance(idx, torch.Tensor)):
+                idx = idx[torch.randperm(n, device=idx.device)]
+            else:
+                idx = idx[np.random.permutation(n)]
+            total_loss = 0.0
+            for i in range(0, n, batch_size):
+                s, a, _, _, _, _ = self._buffer.gather(idx[i:i+batch_size])
+                s = self._normalize_board_t(self._to_device(s))
+                # fit using the actions as assumed to be best, cross entropy
+                # on the logits is the softmax classification loss
+                a = self._to_device(a).argmax(dim=1)
+                self.optimizer.zero_grad()
+                loss = self.criterion(self._model(s), a)
+                loss.backward()
+                self.optimizer.step()
+                # accumulate on the device, read back once per epoch
+                total_loss = total_loss + loss.detach()*a.shape[0]
+        loss = round(float(total_loss)/max(n, 1), 5)
         return loss
 
     def get_max_output(self):
@@ -959,8 +1511,36 @@ class SupervisedLearningAgent(DeepQLearningAgent):
         max_value : int
             The maximum output produced by the network (_model)
         """
-        s, _, _, _, _, _ = self._buffer.sample(self.get_buffer_size())
-        max_value = np.max(np.abs(self._model.predict(self._normalize_board(s))))
+        # the order of the positions does not matter for the max
+        idx = self._get_buffer_indices()
+        max_value = self._streamed_abs_max(self._model, idx)
+        return max_value
+
+    def _streamed_abs_max(self, model, idx, batch_size=1024):
+        """Maximum absolute output of model over the boards at positions
+        idx of the buffer, computed batch by batch so that the boards,
+        outputs and activations for the whole buffer are never held at once
+
+        Parameters
+        ----------
+        model : PyTorch Model
+            The model to run
+        idx : Numpy array or torch Tensor
+            Positions in the buffer, the uint8 boards are gathered and
+            normalized on the device one batch at a time
+        batch_size : int, optional
+            Number of boards per forward pass
+
+        Returns
+        -------
+        max_value : float
+            The maximum absolute output
+        """
+        max_value = 0.0
+        for i in range(0, idx.shape[0], batch_size):
+            s = self._buffer.gather_states(idx[i:i+batch_size])
+            outputs = self._forward_t(self._normalize_board_t(self._to_device(s)), model)
+            max_value = max(max_value, outputs.abs().max().item())
         return max_value
 
     def normalize_layers(self, max_value=None):
@@ -973,129 +1553,45 @@ class SupervisedLearningAgent(DeepQLearningAgent):
             Value by which to divide, assumed to be 1 if None
         """
         # normalize output layers by this value
-        if(max_value is None or np.isnan(max_value)):
+        if(max_value is None or math.isnan(float(max_value))):
             max_value = 1.0
         # dont normalize all layers as that will shrink the
-        # output proportional to the no of layers
-        self._model.get_layer('action_values').set_weights(\
-           [x/max_value for x in self._model.get_layer('action_values').get_weights()])
+        # output proportional to the no of layers, the output
+        # layer weights are divided in place
+        with torch.no_grad():
+            for w in self._model.out.parameters():
+                w /= max_value
 
 class BreadthFirstSearchAgent(Agent):
     """
     finds the shortest path from head to food
     while avoiding the borders and body
     """
-    def _get_neighbors(self, point, values, board):
-        """
-        point is a single integer such that 
-        row = point//self._board_size
-        col = point%self._board_size
-        """
-        row, col = self._point_to_row_col(point)
-        neighbors = []
-        for delta_row, delta_col in [[-1,0], [1,0], [0,1], [0,-1]]:
-            new_row, new_col = row + delta_row, col + delta_col
-            if(board[new_row][new_col] in \
-               [values['board'], values['food'], values['head']]):
-                neighbors.append(new_row*self._board_size + new_col)
-        return neighbors
-
     def _get_shortest_path(self, board, values):
+        """Shortest path from the head to the food on the current frame,
+        the search itself runs in the compiled _bfs
+
+        Returns
+        -------
+        path : Numpy array
+            Flattened positions from the food back to the head,
+            empty if the food cannot be reached
+        """
         # get the head coordinate
         board = board[:,:,0]
-        head = ((self._board_grid * (board == values['head'])).sum())
-        points_to_search = deque()
-        points_to_search.append(head)
-        path = []
-        row, col = self._point_to_row_col(head)
-        distances = np.ones((self._board_size, self._board_size)) * np.inf
-        distances[row][col] = 0
-        visited = np.zeros((self._board_size, self._board_size))
-        visited[row][col] = 1
-        found = False
-        while(not found):
-            if(len(points_to_search) == 0):
-                # complete board has been explored without finding path
-                # take any arbitrary action
-                path = []
-                break
-            else:
-                curr_point = points_to_search.popleft()
-                curr_row, curr_col = self._point_to_row_col(curr_point)
-                n = self._get_neighbors(curr_point, values, board)
-                if(len(n) == 0):
-                    # no neighbors available, explore other paths
-                    continue
-                # iterate over neighbors and calculate distances
-                for p in n:
-                    row, col = self._point_to_row_col(p)
-                    if(distances[row][col] > 1 + distances[curr_row][curr_col]):
-                        # update shortest distance
-                        distances[row][col] = 1 + distances[curr_row][curr_col]
-                    if(board[row][col] == values['food']):
-                        # reached food, break
-                        found = True
-                        break
-                    if(visited[row][col] == 0):
-                        visited[curr_row][curr_col] = 1
-                        points_to_search.append(p)
-        # create the path going backwards from the food
-        curr_point = ((self._board_grid * (board == values['food'])).sum())
-        path.append(curr_point)
-        while(1):
-            curr_row, curr_col = self._point_to_row_col(curr_point)
-            if(distances[curr_row][curr_col] == np.inf):
-                # path is not possible
-                return []
-            if(distances[curr_row][curr_col] == 0):
-                # path is complete
-                break
-            n = self._get_neighbors(curr_point, values, board)
-            for p in n:
-                row, col = self._point_to_row_col(p)
-                if(distances[row][col] != np.inf and \
-                   distances[row][col] == distances[curr_row][curr_col] - 1):
-                    path.append(p)
-                    curr_point = p
-                    break
-        return path
+        head = self._find_cell(board, values['head'])
+        path, length = _bfs(board, head, self._neighbor_table,
+                            self._row_of, self._col_of,
+                            values['food'], values['board'], values['head'])
+        return path[:length]
 
     def move(self, board, legal_moves, values):
         if(board.ndim == 3):
             board = board.reshape((1,) + board.shape)
-        board_main = board.copy()
-        a = np.zeros((board.shape[0],), dtype=np.uint8)
-        for i in range(board.shape[0]):
-            board = board_main[i,:,:,:]
-            path = self._get_shortest_path(board, values)
-            if(len(path) == 0):
-                a[i] = 1
-                continue
-            next_head = path[-2]
-            curr_head = (self._board_grid * (board[:,:,0] == values['head'])).sum()
-            # get prev head position
-            if(((board[:,:,0] == values['head']) + (board[:,:,0] == values['snake']) \
-                == (board[:,:,1] == values['head']) + (board[:,:,1] == values['snake'])).all()):
-                # we are at the first frame, snake position is unchanged
-                prev_head = curr_head - 1
-            else:
-                # we are moving
-                prev_head = (self._board_grid * (board[:,:,1] == values['head'])).sum()
-            curr_head_row, curr_head_col = self._point_to_row_col(curr_head)
-            prev_head_row, prev_head_col = self._point_to_row_col(prev_head)
-            next_head_row, next_head_col = self._point_to_row_col(next_head)
-            dx, dy = next_head_col - curr_head_col, -next_head_row + curr_head_row
-            if(dx == 1 and dy == 0):
-                a[i] = 0
-            elif(dx == 0 and dy == 1):
-                a[i] = 1
-            elif(dx == -1 and dy == 0):
-                a[i] = 2
-            elif(dx == 0 and dy == -1):
-                a[i] = 3
-            else:
-                a[i] = 0
-        return a
+        # the boards are independent, search all of them in one
+        # parallel compiled call instead of a python loop
+        return _bfs_batch(board, self._neighbor_table, self._row_of, self._col_of,
+                          values['food'], values['board'], values['head'])
         """
         d1 = (curr_head_row - prev_head_row, curr_head_col - prev_head_col)
         d2 = (next_head_row - curr_head_row, next_head_col - curr_head_col)
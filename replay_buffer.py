@@ -1,4 +1,6 @@
+import os
 import numpy as np
+import torch
 from collections import deque
 
 class ReplayBuffer:
@@ -129,14 +131,30 @@ class ReplayBufferNumpy:
     sampling is also faster. This is best utilised when using the Numpy array
     based game env
 
+    The next states are not stored separately, since the next states of one
+    addition are the current states of the following addition when playing
+    sequentially. Every transition instead keeps the position of its next
+    state in _s. The next states of the latest addition are kept aside in
+    _next_s_last until the following addition arrives. If the following
+    addition does not continue from them (eg. the env was reset), those
+    transitions lose their next state and are no longer sampled
+
     Attributes
     ----------
     _s : Numpy array
         Buffer for storing the current states, 
-        buffer size * board size * board size * frames
-    _next_s : Numpy array
-        Buffer for storing the next states, 
-        buffer size * board size * board size * frames
+        buffer size * frames * board size * board size
+        (channels first, as used by the conv layers, the env boards
+        are transposed when they are added)
+        stored as uint8 since the boards only contain small integers,
+        the agent normalizes them after uploading to the device
+    _next_idx : Numpy array
+        Position of the next state in _s for every transition, buffer size * 1
+        -1 if the next state is in _next_s_last, -2 if it is not available
+    _next_s_last : Numpy array
+        Next states of the latest addition to the buffer
+    _last_idx : Numpy array
+        Positions in the buffer of the latest addition
     _a : Numpy array
         Buffer to store the actions, buffer size * 1
     _done : Numpy array
@@ -156,6 +174,9 @@ class ReplayBufferNumpy:
         to be added to the buffer
     _n_actions : int
         Available actions in the env
+    _version : int
+        Incremented every time the contents change, so that data derived
+        from the buffer can be cached until the next change
     """
     def __init__(self, buffer_size=1000, board_size=6, frames=2, actions=4):
         """Initializes the buffer with given size and also sets attributes
@@ -175,9 +196,12 @@ class ReplayBufferNumpy:
         self._current_buffer_size = 0
         self._pos = 0
         self._n_actions = actions
+        self._version = 0
 
-        self._s = np.zeros((buffer_size, board_size, board_size, frames), dtype=np.uint8)
-        self._next_s = self._s.copy()
+        self._s = np.zeros((buffer_size, frames, board_size, board_size), dtype=np.uint8)
+        self._next_idx = -2 * np.ones((buffer_size,), dtype=np.int32)
+        self._next_s_last = None
+        self._last_idx = None
         self._a = np.zeros((buffer_size,), dtype=np.uint8)
         self._done = self._a.copy()
         self._r = np.zeros((buffer_size,), dtype=np.int16)
@@ -204,22 +228,32 @@ class ReplayBufferNumpy:
         """
         if(s.ndim == 3):
             # single board is supplied
-            l = 1
-        else:
-            # multiple data points to be added
-            l = s.shape[0]
+            s, next_s = s.reshape((1,) + s.shape), next_s.reshape((1,) + next_s.shape)
+        l = s.shape[0]
+        # env boards are channels last, the buffer is channels first
+        s, next_s = s.transpose(0, 3, 1, 2), next_s.transpose(0, 3, 1, 2)
         # % is to wrap over the buffer
         idx = np.arange(self._pos, self._pos+l)%self._buffer_size
+        if(self._last_idx is not None):
+            # link the previous addition to these states if we continue
+            # from its next states, otherwise its next states are lost
+            if(self._next_s_last.shape == s.shape and np.array_equal(self._next_s_last, s)):
+                self._next_idx[self._last_idx] = idx
+            else:
+                self._next_idx[self._last_idx] = -2
         self._s[idx] = s
+        self._next_idx[idx] = -1
         self._a[idx] = a
         self._r[idx] = r
-        self._next_s[idx] = next_s
         self._done[idx] = done
         self._legal_moves[idx] = legal_moves
+        self._next_s_last = next_s.astype(np.uint8)
+        self._last_idx = idx
         # % is to wrap over the buffer
         self._pos = (self._pos+l)%self._buffer_size
         # update the buffer size
-        self._current_buffer_size = max(self._current_buffer_size, self._pos+1)
+        self._current_buffer_size = min(self._current_buffer_size+l, self._buffer_size)
+        self._version += 1
 
     def get_current_size(self):
         """Returns current buffer size, not to be confused with
@@ -232,6 +266,74 @@ class ReplayBufferNumpy:
         """
         return self._current_buffer_size
 
+    def get_version(self):
+        """Returns the version of the buffer contents, it changes every
+        time data is added or loaded, so anything derived from the buffer
+        can be reused while the version stays the same
+
+        Returns
+        -------
+        version : int
+            Current version of the buffer
+        """
+        return self._version
+
+    def _valid_idx(self):
+        """Positions of all the transitions whose next state is available
+
+        Returns
+        -------
+        idx : Numpy array
+            Positions in the buffer which can be sampled
+        """
+        return np.flatnonzero(self._next_idx[:self._current_buffer_size] != -2)
+
+    def gather(self, idx):
+        """Collect the transitions at the given positions of the buffer
+
+        Parameters
+        ----------
+        idx : Numpy array
+            Positions in the buffer to collect
+
+        Returns
+        -------
+        s, a, r, next_s, done, legal_moves : tuple
+            See sample for the details
+        """
+        s = self._s[idx]
+        # one hot encoding of actions
+        a = np.zeros((idx.shape[0],self._n_actions))
+        a[np.arange(idx.shape[0]),self._a[idx]] = 1
+        r = self._r[idx].reshape((-1, 1))
+        # next states are either elsewhere in the buffer or in the latest addition
+        next_idx = self._next_idx[idx]
+        next_s = self._s[next_idx]
+        m = next_idx == -1
+        if(m.any()):
+            next_s[m] = self._next_s_last[(idx[m] - self._last_idx[0])%self._buffer_size]
+        done = self._done[idx].reshape(-1, 1)
+        legal_moves = self._legal_moves[idx]
+
+        return s, a, r, next_s, done, legal_moves
+
+    def gather_states(self, idx):
+        """Collect only the states at the given positions of the buffer,
+        for consumers which do not need the next states and would otherwise
+        pay for rebuilding them in gather
+
+        Parameters
+        ----------
+        idx : Numpy array
+            Positions in the buffer to collect
+
+        Returns
+        -------
+        s : Numpy array
+            The states, size * frame count * board size * board size
+        """
+        return self._s[idx]
+
     def sample(self, size=1000, replace=False, shuffle=False):
         """Sample data from buffer and return in easily ingestible form
         returned data has already been reshaped for direct use in the 
@@ -249,31 +351,402 @@ class ReplayBufferNumpy:
         Returns
         -------
         s : Numpy array
-            The state matrix for input, size * board size * board size * frame count
+            The state matrix for input, size * frame count * board size * board size
         a : Numpy array
             Array of actions taken in one hot encoded format, size * num actions
         r : Numpy array
             Array of rewards, size * 1
         next_s : Numpy array
             The next state matrix for input
-            The state matrix for input, size * board size * board size * frame count
+            The state matrix for input, size * frame count * board size * board size
         done : Numpy array
             Binary indicators for game termination, size * 1
         legal_moves : Numpy array
             Binary indicators for legal moves in the next state, size * num actions
         """
-        size = min(size, self._current_buffer_size)
-        # select random indexes indicating which examples to sample
-        idx = np.random.choice(np.arange(self._current_buffer_size), \
-                                    size=size, replace=replace)
+        return self.gather(self.sample_indices(size, replace=replace))
 
-        s = self._s[idx]
+    def sample_indices(self, size=1000, replace=False):
+        """Select random positions of the buffer to sample, the data at these
+        positions can be collected with gather. Useful when the caller wants
+        to draw a larger candidate set and keep only part of it for training
+
+        Parameters
+        ----------
+        size : int, optional
+            The number of positions to return
+        replace : bool, optional
+            Whether sampling is done with replacement
+
+        Returns
+        -------
+        idx : Numpy array
+            Positions in the buffer
+        """
+        if(replace):
+            size = min(size, self._current_buffer_size)
+            # draw all the positions at once and redraw the (rare) ones without
+            # a next state, the latest addition is always valid so this ends
+            idx = np.random.randint(0, self._current_buffer_size, size)
+            invalid = self._next_idx[idx] == -2
+            while(invalid.any()):
+                idx[invalid] = np.random.randint(0, self._current_buffer_size, invalid.sum())
+                invalid = self._next_idx[idx] == -2
+            return idx
+        valid_idx = self._valid_idx()
+        size = min(size, valid_idx.shape[0])
+        return np.random.choice(valid_idx, size=size, replace=False)
+
+    def view_all(self):
+        """Return the complete filled part of the buffer without sampling,
+        useful when all the stored data is used for training at once.
+        This is a gather of every valid position, so the returned arrays
+        are copies and the next states are rebuilt for the whole buffer
+
+        Returns
+        -------
+        s : Numpy array
+            The state matrix for input, size * frame count * board size * board size
+        a : Numpy array
+            Array of actions taken in one hot encoded format, size * num actions
+        r : Numpy array
+            Array of rewards, size * 1
+        next_s : Numpy array
+            The next state matrix for input
+            The state matrix for input, size * frame count * board size * board size
+        done : Numpy array
+            Binary indicators for game termination, size * 1
+        legal_moves : Numpy array
+            Binary indicators for legal moves in the next state, size * num actions
+        """
+        return self.gather(self._valid_idx())
+
+    def _to_numpy(self, x):
+        """Convert a buffer array to Numpy for saving"""
+        return np.asarray(x)
+
+    def _from_numpy(self, x):
+        """Convert a loaded Numpy array to the buffer array type"""
+        return x
+
+    def save(self, path):
+        """Save the buffer to disk, every array goes to its own .npy file
+        inside the directory path so that load can memory map them
+
+        Parameters
+        ----------
+        path : str
+            Directory to save the buffer in, created if not present
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ['_s', '_next_idx', '_a', '_done', '_r', '_legal_moves',
+                     '_next_s_last', '_last_idx']:
+            if(getattr(self, name) is not None):
+                np.save(os.path.join(path, name + '.npy'),
+                        self._to_numpy(getattr(self, name)))
+        np.save(os.path.join(path, '_pos.npy'),
+                np.array([self._pos, self._current_buffer_size]))
+
+    def load(self, path):
+        """Load a buffer saved with save, replacing the current contents.
+        The files are memory mapped copy on write, so the data is only read
+        from disk when accessed and the files are never modified. For
+        ReplayBufferTorch the arrays are copied to the device here, which
+        reads the whole files (see ReplayBufferTorch._from_numpy)
+
+        Parameters
+        ----------
+        path : str
+            Directory the buffer was saved in
+
+        Raises
+        ------
+        FileNotFoundError
+            If the buffer files could not be located on the disk
+        """
+        for name in ['_s', '_next_idx', '_a', '_done', '_r', '_legal_moves']:
+            setattr(self, name, self._from_numpy(
+                        np.load(os.path.join(path, name + '.npy'), mmap_mode='c')))
+        for name in ['_next_s_last', '_last_idx']:
+            f = os.path.join(path, name + '.npy')
+            setattr(self, name, self._from_numpy(np.load(f)) if os.path.exists(f) else None)
+        self._pos, self._current_buffer_size = \
+                    [int(x) for x in np.load(os.path.join(path, '_pos.npy'))]
+        self._buffer_size = self._s.shape[0]
+        self._n_actions = self._legal_moves.shape[1]
+        self._version += 1
+
+    def load_legacy(self, buffer):
+        """Fill the buffer from a ReplayBufferNumpy pickled by older
+        versions, which stored the full next states channels last. The
+        rows are added in the order they were added in, as a single block,
+        so every next state is kept in _next_s_last
+
+        Parameters
+        ----------
+        buffer : ReplayBufferNumpy
+            The unpickled buffer, only its arrays and positions are read
+        """
+        # the old _current_buffer_size does not reach the buffer size when
+        # wrapping, instead check if the row at _pos was already written to,
+        # boards always have the border so a written row is never all zeros
+        if(buffer._s[buffer._pos].any()):
+            # the buffer has wrapped, the oldest row is at _pos
+            idx = (buffer._pos + np.arange(buffer._buffer_size))%buffer._buffer_size
+        else:
+            idx = np.arange(buffer._pos)
+        if(idx.shape[0] > 0):
+            self.add_to_buffer(buffer._s[idx], buffer._a[idx], buffer._r[idx],
+                               buffer._next_s[idx], buffer._done[idx],
+                               buffer._legal_moves[idx])
+
+class ReplayBufferTorch(ReplayBufferNumpy):
+    """This class stores the replay buffer as torch tensors which live
+    on the same device as the model. Sampling is done on the device
+    with index_select, so a sampled batch never has to be copied from
+    the host, only the newly added data crosses over to the device.
+    The storage layout is the same as ReplayBufferNumpy
+
+    Attributes
+    ----------
+    _device : torch.device
+        The device on which all the buffers are allocated
+    """
+    def __init__(self, buffer_size=1000, board_size=6, frames=2, actions=4,
+                 device='cuda'):
+        """Initializes the buffer with given size and also sets attributes
+
+        Parameters
+        ----------
+        buffer_size : int, optional
+            The size of the buffer
+        board_size : int, optional
+            Board size of the env
+        frames : int, optional
+            Number of frames used in each state in env
+        actions : int, optional
+            Number of actions available in env
+        device : str or torch.device, optional
+            Device on which to keep the buffer
+        """
+        self._buffer_size = buffer_size
+        self._current_buffer_size = 0
+        self._pos = 0
+        self._n_actions = actions
+        self._version = 0
+        self._device = torch.device(device)
+
+        self._s = torch.zeros((buffer_size, frames, board_size, board_size),
+                              dtype=torch.uint8, device=self._device)
+        self._next_idx = torch.full((buffer_size,), -2, dtype=torch.int64,
+                                    device=self._device)
+        self._next_s_last = None
+        self._last_idx = None
+        self._a = torch.zeros((buffer_size,), dtype=torch.uint8, device=self._device)
+        self._done = self._a.clone()
+        self._r = torch.zeros((buffer_size,), dtype=torch.int16, device=self._device)
+        self._legal_moves = torch.zeros((buffer_size, self._n_actions),
+                                        dtype=torch.uint8, device=self._device)
+
+    def _upload(self, x, dtype):
+        """Convert the incoming data to a tensor on the buffer device"""
+        return torch.as_tensor(np.asarray(x), dtype=dtype, device=self._device)
+
+    def _to_numpy(self, x):
+        """Convert a buffer tensor to Numpy for saving"""
+        return x.cpu().numpy()
+
+    def _from_numpy(self, x):
+        """Convert a loaded Numpy array to a tensor on the buffer device,
+        the whole array is copied so memory mapped files are read in full
+        and loading is not lazy for this buffer"""
+        return torch.from_numpy(np.ascontiguousarray(x)).to(self._device)
+
+    def add_to_buffer(self, s, a, r, next_s, done, legal_moves):
+        """Add data to the buffer, multiple examples can be added at once
+        
+        Parameters
+        ----------
+        s : Numpy array
+            Current board state, should be a single state
+        a : int
+            Current action taken
+        r : int
+            Reward obtained by taking the action on state
+        next_s : Numpy array
+            Board state obtained after taking the action
+            should be a single state
+        done : int
+            Binary indicator for game termination
+        legal_moves : Numpy array
+            Binary indicator for legal moves in the next state
+        """
+        if(s.ndim == 3):
+            # single board is supplied
+            s, next_s = s.reshape((1,) + s.shape), next_s.reshape((1,) + next_s.shape)
+        l = s.shape[0]
+        # env boards are channels last, the buffer is channels first
+        s = self._upload(s, torch.uint8).permute(0, 3, 1, 2)
+        # % is to wrap over the buffer
+        idx = torch.arange(self._pos, self._pos+l, device=self._device)%self._buffer_size
+        if(self._last_idx is not None):
+            # link the previous addition to these states if we continue
+            # from its next states, otherwise its next states are lost
+            if(self._next_s_last.shape == s.shape and torch.equal(self._next_s_last, s)):
+                self._next_idx[self._last_idx] = idx
+            else:
+                self._next_idx[self._last_idx] = -2
+        self._s[idx] = s
+        self._next_idx[idx] = -1
+        self._a[idx] = self._upload(a, torch.uint8)
+        self._r[idx] = self._upload(r, torch.int16)
+        self._done[idx] = self._upload(done, torch.uint8)
+        self._legal_moves[idx] = self._upload(legal_moves, torch.uint8)
+        self._next_s_last = self._upload(next_s, torch.uint8).permute(0, 3, 1, 2)
+        self._last_idx = idx
+        # % is to wrap over the buffer
+        self._pos = (self._pos+l)%self._buffer_size
+        # update the buffer size
+        self._current_buffer_size = min(self._current_buffer_size+l, self._buffer_size)
+        self._version += 1
+
+    def _valid_idx(self):
+        """Positions of all the transitions whose next state is available
+
+        Returns
+        -------
+        idx : torch Tensor
+            Positions in the buffer which can be sampled
+        """
+        return torch.nonzero(self._next_idx[:self._current_buffer_size] != -2).squeeze(1)
+
+    def gather(self, idx):
+        """Collect the transitions at the given positions of the buffer
+
+        Parameters
+        ----------
+        idx : torch Tensor
+            Positions in the buffer to collect
+
+        Returns
+        -------
+        s, a, r, next_s, done, legal_moves : tuple
+            See sample for the details
+        """
+        s = self._s.index_select(0, idx)
         # one hot encoding of actions
-        a = np.zeros((idx.shape[0],self._n_actions))
-        a[np.arange(idx.shape[0]),self._a[idx]] = 1
-        r = self._r[idx].reshape((-1, 1))
-        next_s = self._next_s[idx]
-        done = self._done[idx].reshape(-1, 1)
-        legal_moves = self._legal_moves[idx]
+        a = torch.nn.functional.one_hot(self._a.index_select(0, idx).long(),
+                                        self._n_actions)
+        r = self._r.index_select(0, idx).reshape((-1, 1))
+        # next states are either elsewhere in the buffer or in the latest addition
+        # both candidates are gathered with clamped positions and selected
+        # with a mask, so no step depends on values read back from the device
+        next_idx = self._next_idx.index_select(0, idx)
+        next_s = self._s.index_select(0, next_idx.clamp(min=0))
+        if(self._next_s_last is not None):
+            last_idx = ((idx - self._last_idx[0])%self._buffer_size)\
+                            .clamp(max=self._next_s_last.shape[0]-1)
+            next_s = torch.where((next_idx == -1)[:, None, None, None],
+                                 self._next_s_last.index_select(0, last_idx), next_s)
+        done = self._done.index_select(0, idx).reshape(-1, 1)
+        legal_moves = self._legal_moves.index_select(0, idx)
 
         return s, a, r, next_s, done, legal_moves
+
+    def gather_states(self, idx):
+        """Collect only the states at the given positions of the buffer,
+        the returned tensor stays on the device
+
+        Parameters
+        ----------
+        idx : torch Tensor
+            Positions in the buffer to collect
+
+        Returns
+        -------
+        s : torch Tensor
+            The states, size * frame count * board size * board size
+        """
+        return self._s.index_select(0, idx)
+
+    def sample(self, size=1000, replace=False, shuffle=False):
+        """Sample data from buffer, the indices are generated on the device
+        and all the returned tensors stay on the device
+
+        Parameters
+        ----------
+        size : int, optional
+            The number of samples to return from the buffer
+        replace : bool, optional
+            Whether sampling is done with replacement
+        shuffle : bool, optional
+            Redundant here as the index are already shuffled
+
+        Returns
+        -------
+        s : torch Tensor
+            The state matrix for input, size * frame count * board size * board size
+        a : torch Tensor
+            Array of actions taken in one hot encoded format, size * num actions
+        r : torch Tensor
+            Array of rewards, size * 1
+        next_s : torch Tensor
+            The next state matrix for input
+            The state matrix for input, size * frame count * board size * board size
+        done : torch Tensor
+            Binary indicators for game termination, size * 1
+        legal_moves : torch Tensor
+            Binary indicators for legal moves in the next state, size * num actions
+        """
+        return self.gather(self.sample_indices(size, replace=replace))
+
+    def sample_indices(self, size=1000, replace=False):
+        """Select random positions of the buffer to sample, generated on the
+        device. The data at these positions can be collected with gather
+
+        Parameters
+        ----------
+        size : int, optional
+            The number of positions to return
+        replace : bool, optional
+            Whether sampling is done with replacement
+
+        Returns
+        -------
+        idx : torch Tensor
+            Positions in the buffer
+        """
+        valid_idx = self._valid_idx()
+        if(replace):
+            # draw directly into the valid positions, a rejection loop would
+            # read the drawn positions back from the device on every round
+            size = min(size, self._current_buffer_size)
+            idx = torch.randint(0, valid_idx.shape[0], (size,), device=self._device)
+        else:
+            size = min(size, valid_idx.shape[0])
+            idx = torch.randperm(valid_idx.shape[0], device=self._device)[:size]
+        return valid_idx.index_select(0, idx)
+
+    def view_all(self):
+        """Return the complete filled part of the buffer without sampling,
+        all the returned tensors stay on the device. This is a gather of
+        every valid position, so the returned tensors are copies and the
+        next states are rebuilt for the whole buffer
+
+        Returns
+        -------
+        s : torch Tensor
+            The state matrix for input, size * frame count * board size * board size
+        a : torch Tensor
+            Array of actions taken in one hot encoded format, size * num actions
+        r : torch Tensor
+            Array of rewards, size * 1
+        next_s : torch Tensor
+            The next state matrix for input
+            The state matrix for input, size * frame count * board size * board size
+        done : torch Tensor
+            Binary indicators for game termination, size * 1
+        legal_moves : torch Tensor
+            Binary indicators for legal moves in the next state, size * num actions
+        """
+        return self.gather(self._valid_idx())
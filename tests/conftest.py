@@ -0,0 +1,8 @@
+"""
+make the modules in the repository root importable from the tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,37 @@
+"""
+checks for the agent input preparation
+"""
+
+import numpy as np
+from agent import DeepQLearningAgent
+
+
+def _make_agent():
+    return DeepQLearningAgent(board_size=10, frames=2, n_actions=4,
+                              buffer_size=100, version='v17.1')
+
+
+def _make_boards(n):
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 5, size=(n, 10, 10, 2)).astype(np.float64)
+
+
+def test_prepare_input_does_not_modify_board():
+    agent = _make_agent()
+    board = _make_boards(8)
+    original = board.copy()
+    prepared = agent._prepare_input(board)
+    assert np.array_equal(board, original)
+    assert not np.shares_memory(prepared, board)
+    assert prepared.dtype == np.float32
+    assert np.allclose(prepared, original/4.0)
+
+
+def test_prepare_input_single_board():
+    agent = _make_agent()
+    board = _make_boards(1)[0]
+    original = board.copy()
+    prepared = agent._prepare_input(board)
+    assert prepared.shape == (1,) + board.shape
+    assert np.array_equal(board, original)
+    assert not np.shares_memory(prepared, board)